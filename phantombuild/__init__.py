@@ -15,6 +15,7 @@ from .phantombuild import (
     checkout_phantom_version,
     get_phantom,
     patch_phantom,
+    patch_phantom_batch,
     read_config,
     schedule_job,
     setup_calculation,
@@ -27,6 +28,7 @@ __all__ = [
     'checkout_phantom_version',
     'get_phantom',
     'patch_phantom',
+    'patch_phantom_batch',
     'read_config',
     'schedule_job',
     'setup_calculation',
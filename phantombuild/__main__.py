@@ -1,9 +1,21 @@
 """Phantom-build command line program."""
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
 import click
 
 from . import __version__
-from .phantombuild import build_phantom, read_config, setup_calculation, write_config
+from .phantombuild import (
+    _resolved_path,
+    build_phantom,
+    read_config,
+    schedule_job,
+    setup_calculation,
+    write_config,
+)
 
 
 @click.group()
@@ -48,13 +60,49 @@ def setup(ctx, config):
     if len(config) == 0:
         click.echo(ctx.get_help())
         ctx.exit()
+
+    # Configs sharing a Phantom repository are built one after the other;
+    # configs with distinct repositories are built concurrently
+    groups: Dict[Path, List[Dict[str, Any]]] = dict()
     for _config in config:
         conf = read_config(_config)
-        build_phantom(**conf['phantom'])
-        phantom_path = conf['phantom']['path']
-        for run in conf.get('runs', []):
-            run_path = run.pop('path')
-            setup_calculation(run_path=run_path, phantom_path=phantom_path, **run)
+        groups.setdefault(_resolved_path(conf['phantom']['path']), []).append(conf)
+    with ThreadPoolExecutor(max_workers=_max_workers(len(groups))) as executor:
+        futures = [
+            executor.submit(_build_and_setup, phantom_path, confs)
+            for phantom_path, confs in groups.items()
+        ]
+        for future in futures:
+            future.result()
+
+
+def _build_and_setup(phantom_path: Path, confs: List[Dict[str, Any]]):
+    # phantom_path is already resolved, so is passed on in place of the path in
+    # each config rather than resolving it again per build and run
+    for conf in confs:
+        build_phantom(**{**conf['phantom'], 'path': phantom_path})
+        runs = conf.get('runs', [])
+        with ThreadPoolExecutor(max_workers=_max_workers(len(runs))) as executor:
+            futures = [executor.submit(_setup_run, phantom_path, run) for run in runs]
+            run_paths = [future.result() for future in futures]
+        # Submit jobs one at a time, in the order of the runs, once all runs are
+        # set up
+        for run_path, run in zip(run_paths, runs):
+            if run.get('job_script') is not None:
+                schedule_job(run_path=run_path, job_script=run['job_script'])
+
+
+def _setup_run(phantom_path: Path, run: Dict[str, Any]) -> Path:
+    run_path = _resolved_path(run['path'])
+    options = {
+        key: val for key, val in run.items() if key not in ('path', 'job_script')
+    }
+    setup_calculation(run_path=run_path, phantom_path=phantom_path, **options)
+    return run_path
+
+
+def _max_workers(n_jobs: int) -> int:
+    return max(1, min(n_jobs, os.cpu_count() or 1))
 
 
 if __name__ == '__main__':
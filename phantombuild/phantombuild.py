@@ -1,25 +1,39 @@
 """Phantom build."""
 
+import atexit
+import configparser
+import copy
+import filecmp
+import functools
+import hashlib
 import logging
+import logging.handlers
 import os
 import pathlib
+import platform
+import selectors
 import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from logging import Logger
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-import tomlkit
 from jinja2 import Template
 
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
 REPO_URL = 'https://github.com/danieljprice/phantom.git'
-GIT_URLS = [
-    'git@github.com:danieljprice/phantom',
-    'git@github.com:danieljprice/phantom.git',
-    'https://github.com/danieljprice/phantom',
-    'https://github.com/danieljprice/phantom.git',
-]
+# Phantom remotes with the scheme, user, and '.git' suffix removed, see
+# _normalized_remote
+PHANTOM_REMOTES = frozenset({'github.com/danieljprice/phantom'})
 
 
 class RepoError(Exception):
@@ -50,44 +64,119 @@ class TOMLError(Exception):
     """Exception for dealing with reading TOML files."""
 
 
-def _setup_logger(filename: Path = None) -> Logger:
-
-    if filename is None:
-        filename = pathlib.Path('.phantom-build.log').expanduser()
+def _setup_logger() -> Logger:
 
     logger = logging.getLogger('phantom-build')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.INFO)
 
-    console_handler = logging.StreamHandler()
-    file_handler = logging.FileHandler(filename, mode='w')
+    return logger
 
-    console_format = logging.Formatter(
-        '%(name)s %(levelname)s: %(funcName)s - %(message)s'
-    )
-    file_format = logging.Formatter(
-        '%(asctime)s %(name)s %(levelname)s: %(funcName)s - %(message)s',
-        '%Y-%m-%d %H:%M:%S',
-    )
-    console_handler.setFormatter(console_format)
-    file_handler.setFormatter(file_format)
 
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+def _ensure_logger(filename: Path = None):
+    # Attach the console and file handlers on first use, rather than at import,
+    # so that importing phantombuild does not create or truncate the log file
+    global _LOGGER_INITIALIZED
 
-    logger.setLevel(logging.INFO)
+    with _LOGGER_LOCK:
+        if _LOGGER_INITIALIZED:
+            return
 
-    return logger
+        if filename is None:
+            filename = pathlib.Path('.phantom-build.log').expanduser()
 
+        console_handler = logging.StreamHandler()
+        file_handler = logging.FileHandler(filename, mode='w')
 
-logger = _setup_logger()
+        console_format = logging.Formatter(
+            '%(name)s %(levelname)s: %(funcName)s - %(message)s'
+        )
+        file_format = logging.Formatter(
+            '%(asctime)s %(name)s %(levelname)s: %(funcName)s - %(message)s',
+            '%Y-%m-%d %H:%M:%S',
+        )
+        console_handler.setFormatter(console_format)
+        file_handler.setFormatter(file_format)
+
+        # Buffer records for the log file, writing them out in batches or as
+        # soon as an error is logged
+        memory_handler = logging.handlers.MemoryHandler(
+            capacity=256, flushLevel=logging.ERROR, target=file_handler
+        )
+        atexit.register(memory_handler.flush)
+
+        logger.addHandler(console_handler)
+        logger.addHandler(memory_handler)
+
+        _LOGGER_INITIALIZED = True
 
 
-def get_phantom(path: Union[Path, str]) -> bool:
+logger = _setup_logger()
+_LOGGER_INITIALIZED = False
+_LOGGER_LOCK = threading.Lock()
+
+# Build outputs, relative to the Phantom repository, kept in the build cache
+_BUILD_ARTIFACTS = (
+    Path('bin/phantom'),
+    Path('bin/phantomsetup'),
+    Path('bin/phantom_version'),
+    Path('build/build_output.log'),
+)
+
+# Environment variables that change how make compiles Phantom, and so are part
+# of the build cache key, see _build_cache_dir
+_BUILD_CACHE_ENV = (
+    'FC',
+    'FFLAGS',
+    'FPPFLAGS',
+    'DBLFLAG',
+    'CC',
+    'CCFLAGS',
+    'LDFLAGS',
+    'LIBS',
+)
+
+# Seconds between flushes of the build log when not piping through tee
+_LOG_FLUSH_INTERVAL = 30
+
+# Git state verified during this session. _GIT_STATE_CACHE maps (path, version)
+# to 'clean' once that version is checked out with a clean working tree,
+# _CLEAN_WORKTREES maps a repository path to the signature of HEAD (see
+# _head_signature) when its working tree was last found to be clean, and
+# _REMOTE_CACHE maps a repository path to the signature of its .git/config
+# when it was last verified to be a clone of Phantom.
+_GIT_STATE_CACHE: Dict[Tuple[Path, str], str] = dict()
+_CLEAN_WORKTREES: Dict[Path, Tuple[int, ...]] = dict()
+_REMOTE_CACHE: Dict[Path, Tuple[int, int]] = dict()
+# Output of read-only git commands, keyed by repository path, the state of HEAD
+# (see _head_signature), and the git arguments
+_GIT_CACHE: Dict[Tuple[Path, Tuple[int, ...], Tuple[str, ...]], str] = dict()
+# Guards updates to the caches above, as the CLI builds in several threads
+_GIT_STATE_LOCK = threading.Lock()
+
+
+def get_phantom(
+    path: Union[Path, str], version: str = None, shallow: bool = True
+) -> bool:
     """Get Phantom repository.
 
+    The repository is cloned without historical file contents (a
+    "blobless" partial clone); these are fetched on demand by git.
+
     Parameters
     ----------
     path
         The path to the Phantom repository.
+    version
+        The Phantom version that will be checked out after cloning, if
+        any. If provided, a fresh clone skips checking out the default
+        branch, as the working tree will be written by
+        checkout_phantom_version instead.
+    shallow
+        If True, clone only the latest commit of the default branch.
+        checkout_phantom_version fetches the required version later if
+        it is missing. Set to False to clone the full history. Default
+        is True.
 
     Returns
     -------
@@ -99,35 +188,43 @@ def get_phantom(path: Union[Path, str]) -> bool:
     RepoError
         If the repository can not be cloned.
     """
+    _ensure_logger()
     _path = _resolved_path(path)
     logger.info('Getting Phantom repository')
     logger.info(f'path: {_path}')
 
     if not _path.exists():
         logger.info('Cloning fresh copy of Phantom')
-        result = subprocess.run(
-            ['git', 'clone', REPO_URL, _path.stem],
-            cwd=_path.parent,
-        )
-        if result.returncode != 0:
-            logger.error('Phantom clone failed')
-            raise RepoError('Fail to clone repo')
-        else:
-            logger.info('Phantom successfully cloned')
+        clone_command = ['clone', '--filter=blob:none']
+        if shallow:
+            clone_command += ['--depth=1', '--single-branch', '--no-tags']
+        if version is not None:
+            clone_command.append('--no-checkout')
+        _invalidate_git_state(_path)
+        try:
+            _run_git(
+                clone_command + [REPO_URL, _path.stem], cwd=_path.parent, output=False
+            )
+        except subprocess.CalledProcessError as err:
+            logger.error(f'Phantom clone failed: {err.stderr.strip()}')
+            raise RepoError(f'Fail to clone repo: {err.stderr.strip()}') from err
+        logger.info('Phantom successfully cloned')
     else:
-        if not (
-            subprocess.run(
-                ['git', 'config', '--local', '--get', 'remote.origin.url'],
-                cwd=_path,
-                stdout=subprocess.PIPE,
-                text=True,
-            ).stdout.strip()
-            in GIT_URLS
+        signature = _git_config_signature(_path)
+        if (
+            _probe_cache_enabled()
+            and signature is not None
+            and _REMOTE_CACHE.get(_path) == signature
         ):
+            logger.info('Phantom already cloned')
+        elif not _is_phantom_remote(_path):
             msg = f'{path} is not Phantom'
             logger.error(msg)
             raise RepoError(msg)
         else:
+            if signature is not None:
+                with _GIT_STATE_LOCK:
+                    _REMOTE_CACHE[_path] = signature
             logger.info('Phantom already cloned')
 
     return True
@@ -152,55 +249,129 @@ def checkout_phantom_version(path: Union[Path, str], version: str) -> bool:
     ------
     RepoError
         If the required version cannot be checked out.
+
+    Notes
+    -----
+    Once a version is checked out with a clean working tree, further
+    calls for the same path and version return immediately without
+    running git. Patching or re-cloning the repository invalidates this.
+    Likewise, the working tree is only checked for changes if HEAD has
+    moved or the tree was patched since it was last found to be clean, so
+    edits made by hand during the session are not reverted. Set the
+    environment variable PHANTOMBUILD_PROBE_CACHE=0 to disable this
+    caching.
     """
+    _ensure_logger()
     _path = _resolved_path(path)
     logger.info('Getting required Phantom version')
 
-    # Check git commit hash
-    phantom_git_commit_hash = subprocess.run(
-        ['git', 'rev-parse', 'HEAD'],
-        cwd=_path,
-        stdout=subprocess.PIPE,
-        text=True,
-    ).stdout.strip()
-    short_hash = subprocess.run(
-        ['git', 'rev-parse', '--short', version],
-        cwd=_path,
-        stdout=subprocess.PIPE,
-        text=True,
-    ).stdout.strip()
+    if _probe_cache_enabled() and _GIT_STATE_CACHE.get((_path, version)) == 'clean':
+        logger.info('Required version of Phantom already checked out')
+        return True
+    _invalidate_git_state(_path, worktree=False)
+
+    # Check git commit hash; if HEAD cannot be resolved fall through to an
+    # unconditional checkout of the required version
+    phantom_git_commit_hash = _head_commit(_path)
+    if phantom_git_commit_hash is None:
+        try:
+            phantom_git_commit_hash = _cached_git(['rev-parse', 'HEAD'], cwd=_path)
+        except subprocess.CalledProcessError:
+            phantom_git_commit_hash = ''
+    # A commit hash, full or abbreviated to at least 7 characters, given as the
+    # version matches HEAD if it is a prefix of it
+    at_version = phantom_git_commit_hash == version or (
+        _is_hash_prefix(version) and phantom_git_commit_hash.startswith(version)
+    )
+
+    # Fetch the required version if it is missing from a shallow clone: a
+    # full commit hash is fetched on its own, otherwise the full history of
+    # all branches and tags is fetched, as the clone only tracks the default
+    # branch
+    if not at_version and (_path / '.git/shallow').exists():
+        if _is_full_hash(version):
+            logger.info('Fetching required Phantom version')
+            try:
+                _run_git(
+                    ['fetch', '--depth=1', 'origin', version], cwd=_path, output=False
+                )
+            except subprocess.CalledProcessError as err:
+                logger.info(f'Failed to fetch version: {err.stderr.strip()}')
+        try:
+            _run_git(['cat-file', '-e', version + '^{commit}'], cwd=_path, output=False)
+        except subprocess.CalledProcessError:
+            logger.info('Fetching full Phantom history')
+            try:
+                _run_git(
+                    ['remote', 'set-branches', 'origin', '*'], cwd=_path, output=False
+                )
+                _run_git(
+                    ['fetch', '--unshallow', '--tags', 'origin'],
+                    cwd=_path,
+                    output=False,
+                )
+            except subprocess.CalledProcessError as err:
+                msg = f'Failed to fetch Phantom history: {err.stderr.strip()}'
+                logger.error(msg)
+                raise RepoError(msg) from err
+    if at_version:
+        short_hash = version[:7] if _is_full_hash(version) else version
+    else:
+        try:
+            short_hash = _cached_git(['rev-parse', '--short', version], cwd=_path)
+        except subprocess.CalledProcessError:
+            short_hash = version
     logger.info(f'Git commit hash: {short_hash}')
-    if phantom_git_commit_hash != version:
+    if not at_version:
         logger.info('Checking out required Phantom version')
-        result = subprocess.run(['git', 'checkout', version], cwd=_path)
-        if result.returncode != 0:
-            msg = 'Failed to checkout required version'
+        try:
+            _run_git(['checkout', version], cwd=_path, output=False)
+        except subprocess.CalledProcessError as err:
+            msg = f'Failed to checkout required version: {err.stderr.strip()}'
             logger.error(msg)
-            raise RepoError(msg)
-        else:
-            logger.info('Successfully checked out required version')
+            raise RepoError(msg) from err
+        logger.info('Successfully checked out required version')
     else:
         logger.info('Required version of Phantom already checked out')
 
-    # Check if clean
-    git_status = subprocess.run(
-        ['git', 'status', '--porcelain'],
-        cwd=_path,
-        stdout=subprocess.PIPE,
-        text=True,
-    ).stdout.strip()
-    if not git_status == '':
+    # Check if clean, unless the working tree was found to be clean during this
+    # session and HEAD has not moved since, nor has it been patched. HEAD can
+    # not be read like this if .git is a file, e.g. in a linked worktree.
+    worktree_verified = False
+    if _probe_cache_enabled():
+        try:
+            worktree_verified = _CLEAN_WORKTREES.get(_path) == _head_signature(_path)
+        except OSError:
+            pass
+    dirty = False
+    if not worktree_verified:
+        try:
+            dirty = _worktree_is_dirty(_path)
+        except subprocess.CalledProcessError as err:
+            msg = f'Failed to check if repo is clean: {err}'
+            logger.error(msg)
+            raise RepoError(msg) from err
+    if dirty:
         logger.info('Cleaning repository')
-        results = list()
-        results.append(subprocess.run(['git', 'reset', 'HEAD'], cwd=_path))
-        results.append(subprocess.run(['git', 'clean', '--force'], cwd=_path))
-        results.append(subprocess.run(['git', 'checkout', '--', '*'], cwd=_path))
-        if any(result.returncode != 0 for result in results):
-            msg = 'Failed to clean repo'
+        try:
+            _run_git(['reset', '--hard', 'HEAD'], cwd=_path, output=False)
+            _run_git(['clean', '-fd'], cwd=_path, output=False)
+        except subprocess.CalledProcessError as err:
+            msg = f'Failed to clean repo: {err.stderr.strip()}'
             logger.error(msg)
-            raise RepoError(msg)
+            raise RepoError(msg) from err
+        logger.info('Successfully cleaned repo')
+
+    try:
+        signature: Optional[Tuple[int, ...]] = _head_signature(_path)
+    except OSError:
+        signature = None
+    with _GIT_STATE_LOCK:
+        _GIT_STATE_CACHE[(_path, version)] = 'clean'
+        if signature is not None:
+            _CLEAN_WORKTREES[_path] = signature
         else:
-            logger.info('Successfully cleaned repo')
+            _CLEAN_WORKTREES.pop(_path, None)
 
     return True
 
@@ -225,19 +396,70 @@ def patch_phantom(path: Union[Path, str], patch: Union[Path, str]) -> bool:
     PatchError
         If the patch cannot be applied.
     """
+    return patch_phantom_batch(path=path, patches=[patch])
+
+
+def patch_phantom_batch(
+    path: Union[Path, str], patches: List[Union[Path, str]]
+) -> bool:
+    """Apply several patches to Phantom in one git invocation.
+
+    The patches are applied in order. If any patch fails to apply, none
+    of them are applied, and the patch that failed is reported.
+
+    Parameters
+    ----------
+    path
+        The path to the Phantom repository.
+    patches
+        A list of paths to patch files.
+
+    Returns
+    -------
+    bool
+        Success or fail as boolean.
+
+    Raises
+    ------
+    PatchError
+        If a patch file does not exist or the patches cannot be applied.
+    """
+    _ensure_logger()
     _path = _resolved_path(path)
-    _patch = _resolved_path(patch)
+    # git apply rejects empty input, so there is nothing to do
+    if not patches:
+        return True
+    with ThreadPoolExecutor(max_workers=len(patches)) as executor:
+        read = list(executor.map(_read_patch, patches))
+    _patches = [_patch for _patch, _ in read]
 
     logger.info('Patching Phantom')
-    logger.info(f'Patch file: {_patch}')
+    for _patch in _patches:
+        logger.info(f'Patch file: {_patch}')
 
-    result = subprocess.run(['git', 'apply', _patch], cwd=_path)
-    if result.returncode != 0:
-        msg = 'Failed to patch Phantom'
+    missing = [str(_patch) for _patch, text in read if text is None]
+    if missing:
+        msg = f'Patch file does not exist: {", ".join(missing)}'
         logger.error(msg)
         raise PatchError(msg)
-    else:
-        logger.info('Successfully patched Phantom')
+
+    _invalidate_git_state(_path)
+    # Feed the patches to git as a single stream, as git only applies each
+    # patch file given on the command line atomically, not all of them
+    texts = [text for _, text in read]
+    try:
+        _run_git(['apply'], cwd=_path, output=False, input=''.join(texts))
+    except subprocess.CalledProcessError as err:
+        stderr = err.stderr.strip()
+        if len(_patches) > 1:
+            failed = _find_failing_patch(_path, _patches, texts)
+            if failed is not None:
+                _patch, stderr = failed
+                stderr = f'{_patch}: {stderr}'
+        msg = f'Failed to patch Phantom: {stderr}'
+        logger.error(msg)
+        raise PatchError(msg) from err
+    logger.info('Successfully patched Phantom')
 
     return True
 
@@ -272,7 +494,11 @@ def build_phantom(
         with HDF5.
     extra_options
         Extra options to pass to make. This values in this dictionary
-        should be strings only.
+        should be strings only. The key 'JOBS' is not passed to make as
+        a variable; instead it sets the number of parallel make jobs,
+        which defaults to the PHANTOMBUILD_JOBS environment variable if
+        set, or the number of CPUs otherwise. A value that is not a
+        positive integer is ignored with a warning.
 
     Returns
     -------
@@ -285,21 +511,36 @@ def build_phantom(
         If phantom or phantomsetup cannot be compiled.
     HDF5LibraryNotFound
         If the HDF5 library cannot be located.
+
+    Notes
+    -----
+    If phantom and phantomsetup are newer than all of the Phantom
+    source files and Makefiles, and were built by phantombuild with the
+    same make options, they are not rebuilt.
+
+    If the environment variable PHANTOMBUILD_CACHE_DIR is set, and a
+    version is given, the binaries and build log are stored in a
+    sub-directory of it keyed by the commit hash, the contents of the
+    patches, the make options, and the toolchain: the host architecture,
+    the compiler version, the compiler environment variables (FC,
+    FFLAGS, FPPFLAGS, DBLFLAG, CC, CCFLAGS, LDFLAGS, and LIBS), and the
+    HDF5 library files. Later builds with the
+    same inputs copy them from there instead of running make. The cache
+    is not used if the compiler version cannot be determined.
     """
+    _ensure_logger()
     _path = _resolved_path(path)
 
     # Get Phantom
-    get_phantom(path=_path)
+    get_phantom(path=_path, version=version)
 
     # Checkout required version (if required)
     if version is not None:
         checkout_phantom_version(path=_path, version=version)
 
     # Apply patches (if required)
-    if patches is not None:
-        for patch in patches:
-            _patch = _resolved_path(patch)
-            patch_phantom(path=_path, patch=_patch)
+    if patches:
+        patch_phantom_batch(path=_path, patches=patches)
 
     logger.info('Building Phantom')
     logger.info(f'setup: {setup}')
@@ -309,64 +550,76 @@ def build_phantom(
     if extra_options is not None:
         logger.info(f'extra_options: {extra_options}')
 
-    make_command = ['make', 'SETUP=' + setup, 'SYSTEM=' + system]
+    make_options = dict(extra_options) if extra_options is not None else dict()
+    jobs = (
+        _parse_jobs(make_options.pop('JOBS', None), 'JOBS')
+        or _parse_jobs(os.environ.get('PHANTOMBUILD_JOBS'), 'PHANTOMBUILD_JOBS')
+        or os.cpu_count()
+        or 1
+    )
+    logger.info(f'jobs: {jobs}')
 
+    make_command = ['make', f'-j{jobs}', f'SETUP={setup}', f'SYSTEM={system}']
+
+    _hdf5_path = None
     if hdf5_path is not None:
         _hdf5_path = _resolved_path(hdf5_path)
         if not _hdf5_path.exists():
             raise HDF5LibraryNotFound('Cannot determine HDF5 library location')
-        make_command += ['HDF5=yes', 'HDF5ROOT=' + str(_hdf5_path.resolve())]
-
-    if extra_options is not None:
-        make_command += [key + '=' + val for key, val in extra_options.items()]
-
-    build_log = _path / 'build' / 'build_output.log'
-    with open(build_log, 'w') as fp:
-        process = subprocess.Popen(
-            make_command,
-            cwd=_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
+        make_command += ['HDF5=yes', f'HDF5ROOT={_hdf5_path}']
+
+    make_command += [f'{key}={val}' for key, val in make_options.items()]
+
+    # Skip make if the binaries are newer than the source and were built with
+    # the same options
+    build_hash = hashlib.sha256('\n'.join(make_command[2:]).encode()).hexdigest()
+    if _build_is_current(_path, build_hash):
+        logger.info('Phantom and Phantomsetup already compiled and up to date')
+        return True
+    build_hash_file = _path / 'bin' / '.build_hash'
+    if build_hash_file.exists():
+        build_hash_file.unlink()
+
+    # Reuse binaries from the build cache, if enabled and the build inputs are
+    # known, i.e. a version was checked out and the compiler can be identified
+    cache_dir = None
+    if version is not None and os.environ.get('PHANTOMBUILD_CACHE_DIR'):
+        cache_dir = _build_cache_dir(
+            _path, patches, make_command[2:], system=system, hdf5_path=_hdf5_path
         )
-        assert process.stdout is not None
-        for line in process.stdout:
-            sys.stdout.write(line)
-            fp.write(line)
-        process.communicate()[0]
-
-    if process.returncode != 0:
-        msg = 'Phantom failed to compile'
-        logger.error(msg)
-        logger.info(f'See "{build_log.name}" in Phantom build directory for output')
-        raise CompileError(msg)
-    else:
-        logger.info('Successfully compiled Phantom')
-        logger.info(f'See "{build_log.name}" in Phantom build directory for output')
-
+        if cache_dir is None:
+            logger.info('Not using build cache: cannot determine compiler version')
+        elif _restore_build(cache_dir, _path):
+            logger.info(f'Phantom and Phantomsetup restored from cache: {cache_dir}')
+            build_hash_file.write_text(build_hash)
+            return True
+
+    # Build the targets one after the other: Phantom's Makefile passes each
+    # goal on to a sub-make in build/, so building them in one parallel make
+    # would run two sub-makes writing the same object files
+    # The log is opened once for both targets, see _run_and_tee
     build_log = _path / 'build' / 'build_output.log'
-    with open(build_log, 'a') as fp:
-        process = subprocess.Popen(
-            make_command + ['setup'],
-            cwd=_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-        )
-        assert process.stdout is not None
-        for line in process.stdout:
-            sys.stdout.write(line)
-            fp.write(line)
-        process.communicate()[0]
-
-    if process.returncode != 0:
-        msg = 'Phantomsetup failed to compile'
-        logger.error(msg)
-        logger.info(f'See "{build_log.name}" in Phantom build directory for output')
-        raise CompileError(msg)
-    else:
-        logger.info('Successfully compiled Phantomsetup')
-        logger.info(f'See "{build_log.name}" in Phantom build directory for output')
+    with open(build_log, 'w+b', buffering=0) as log:
+        for target, name in (('phantom', 'Phantom'), ('setup', 'Phantomsetup')):
+            returncode = _run_and_tee(
+                make_command + [target], cwd=_path, log_fd=log.fileno()
+            )
+            if returncode != 0:
+                msg = f'{name} failed to compile'
+                logger.error(msg)
+                logger.info(
+                    f'See "{build_log.name}" in Phantom build directory for output'
+                )
+                raise CompileError(msg)
+            else:
+                logger.info(f'Successfully compiled {name}')
+                logger.info(
+                    f'See "{build_log.name}" in Phantom build directory for output'
+                )
+
+    build_hash_file.write_text(build_hash)
+    if cache_dir is not None:
+        _store_build(_path, cache_dir)
 
     return True
 
@@ -391,6 +644,7 @@ def schedule_job(run_path: Union[Path, str], job_script: Union[Path, str]):
     ScheduleError
         If the run cannot be scheduled.
     """
+    _ensure_logger()
     logger.info('Scheduling job with Slurm')
     _run_path = _resolved_path(run_path)
     _job_script = _resolved_path(job_script)
@@ -452,6 +706,7 @@ def setup_calculation(
     The parameters prefix, setup_file, and in_file must be consistently
     named.
     """
+    _ensure_logger()
     _run_path = _resolved_path(run_path)
     _setup_file = _resolved_path(setup_file)
     _in_file = _resolved_path(in_file)
@@ -465,34 +720,38 @@ def setup_calculation(
     if not _run_path.exists():
         _run_path.mkdir(parents=True)
 
-    for file in ['phantom', 'phantomsetup', 'phantom_version']:
-        shutil.copy(_phantom_path / 'bin' / file, _run_path)
-
-    shutil.copy(_setup_file, _run_path)
-    shutil.copy(_in_file, _run_path)
-
-    with open(_run_path / f'{prefix}00.log', mode='w') as f:
-        process = subprocess.Popen(
-            ['./phantomsetup', prefix],
-            cwd=_run_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
+    # Hard link the executables where possible, and copy only the contents of
+    # the other files, which uses the kernel fast path; all concurrently
+    links = [
+        (_phantom_path / 'bin' / file, _run_path / file)
+        for file in ('phantom', 'phantomsetup')
+    ]
+    copies = [
+        (_phantom_path / 'bin' / 'phantom_version', _run_path / 'phantom_version')
+    ]
+    copies += [(file, _run_path / file.name) for file in (_setup_file, _in_file)]
+    with ThreadPoolExecutor(max_workers=len(links) + len(copies)) as executor:
+        futures = [executor.submit(_link_or_copy, src, dst) for src, dst in links]
+        futures += [executor.submit(shutil.copyfile, src, dst) for src, dst in copies]
+        for future in futures:
+            future.result()
+
+    with open(_run_path / f'{prefix}00.log', 'w+b', buffering=0) as log:
+        returncode = _run_and_tee(
+            ['./phantomsetup', prefix], cwd=_run_path, log_fd=log.fileno()
         )
-        assert process.stdout is not None
-        for line in process.stdout:
-            sys.stdout.write(line)
-            f.write(line)
-        process.communicate()[0]
 
-    if process.returncode != 0:
+    if returncode != 0:
         msg = 'Phantom failed to set up calculation'
         logger.error(msg)
         raise SetupError(msg)
     else:
         logger.info('Successfully set up Phantom calculation')
 
-    shutil.copy(_in_file, _run_path)
+    # phantomsetup may write its own .in file; restore the requested one
+    run_in_file = _run_path / _in_file.name
+    if not (run_in_file.exists() and filecmp.cmp(_in_file, run_in_file)):
+        shutil.copyfile(_in_file, run_in_file)
 
     # Schedule calculation (if required)
     if job_script is not None:
@@ -523,6 +782,11 @@ def read_config(filename: Union[Path, str]) -> Dict[str, Any]:
             }
         The 'runs' list may be empty.
 
+    Raises
+    ------
+    TOMLError
+        If an extra_options item is not of the form KEY=VALUE.
+
     Examples
     --------
     Read a config file and set up multiple runs.
@@ -534,6 +798,7 @@ def read_config(filename: Union[Path, str]) -> Dict[str, Any]:
     ...     run_path = run.pop('path')
     ...     setup_calculation(run_path=run_path, phantom_path=phantom_path, **run)
     """
+    _ensure_logger()
     _filename = _resolved_path(filename)
     logger.info('Reading config file')
     logger.info(f'config: {_filename}')
@@ -541,8 +806,8 @@ def read_config(filename: Union[Path, str]) -> Dict[str, Any]:
     with open(_filename, mode='r') as fp:
         file = fp.read()
 
-    template = Template(file)
-    data = tomlkit.loads(template.render(env=os.environ))
+    template = _compile_template(file)
+    data = copy.deepcopy(_parse_toml(template.render(env=os.environ)))
 
     phantom_keys = ('path', 'setup', 'system', 'version', 'patches', 'hdf5_path')
     run_keys = ('path', 'prefix', 'setup_file', 'in_file', 'job_script')
@@ -550,10 +815,14 @@ def read_config(filename: Union[Path, str]) -> Dict[str, Any]:
     config: Dict[str, Any] = dict()
 
     d = {key: data['phantom'].get(key) for key in phantom_keys}
-    d['extra_options'] = {
-        item.split('=')[0]: item.split('=')[1]
-        for item in data['phantom'].get('extra_options', [])
-    }
+    d['extra_options'] = dict()
+    for item in data['phantom'].get('extra_options', []):
+        key, sep, val = item.partition('=')
+        if not sep:
+            msg = f'extra_options item "{item}" is not of the form KEY=VALUE'
+            logger.error(msg)
+            raise TOMLError(msg)
+        d['extra_options'][key.strip()] = val.strip()
     config['phantom'] = d
 
     runs = data.get('runs')
@@ -585,5 +854,498 @@ def write_config(filename: Union[Path, str]):
     shutil.copy(Path(__file__).parent / 'template.toml', _filename)
 
 
+def _run_and_tee(command: List[str], cwd: Path, log_fd: int) -> int:
+    # Copy the combined stdout and stderr of command to the terminal and to
+    # the end of the open log file log_fd, which must be opened read-write and
+    # without O_APPEND, e.g. with mode 'w+b', as splice and sendfile require.
+    # Where available, the output is piped straight into tee, which appends to
+    # the log through /dev/fd, so it does not pass through Python at all
+    sys.stdout.flush()
+    os.lseek(log_fd, 0, os.SEEK_END)
+    tee = shutil.which('tee')
+    if tee is not None:
+        process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        tee_process = subprocess.Popen(
+            [tee, '-a', f'/dev/fd/{log_fd}'], stdin=process.stdout, pass_fds=[log_fd]
+        )
+        process.stdout.close()
+        returncode = process.wait()
+        tee_process.wait()
+        return returncode
+
+    # Otherwise move the output through the kernel where os.splice is
+    # available, see _splice_output, or else copy it in large chunks, rather
+    # than decoding and writing line by line, draining all the output available
+    # each time the pipe is ready. The log is then buffered and only flushed
+    # every _LOG_FLUSH_INTERVAL seconds, so it can still be followed while make
+    # is running. Output goes straight to file descriptor 1, as it does through
+    # tee
+    with open(log_fd, 'wb', buffering=1 << 20, closefd=False) as fp:
+        process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        assert process.stdout is not None
+        fd = process.stdout.fileno()
+        if _splice_output(fd, log_fd):
+            process.stdout.close()
+            return process.wait()
+        os.set_blocking(fd, False)
+        last_flush = time.monotonic()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            eof = False
+            while not eof:
+                selector.select()
+                chunk, eof = _read_available(fd)
+                _write_all(1, chunk)
+                fp.write(chunk)
+                now = time.monotonic()
+                if now - last_flush > _LOG_FLUSH_INTERVAL:
+                    fp.flush()
+                    last_flush = now
+        process.stdout.close()
+    return process.wait()
+
+
+def _splice_output(fd: int, log_fd: int) -> bool:
+    # Copy everything from the pipe fd to the log, and to stdout, without it
+    # passing through Python: splice each chunk from the pipe into the log, then
+    # sendfile it from the log to stdout. Returns False, without consuming any
+    # output, if splice is not available or not supported for these files
+    if not hasattr(os, 'splice'):
+        return False
+    first = True
+    while True:
+        offset = os.lseek(log_fd, 0, os.SEEK_CUR)
+        try:
+            count = os.splice(fd, log_fd, 1 << 16)
+        except OSError:
+            if first:
+                return False
+            raise
+        first = False
+        if count == 0:
+            return True
+        sent = 0
+        try:
+            while sent < count:
+                sent += os.sendfile(1, log_fd, offset + sent, count - sent)
+        except OSError:
+            _write_all(1, os.pread(log_fd, count - sent, offset + sent))
+
+
+def _write_all(fd: int, data: bytes):
+    # Write all of data to fd, which may take several writes
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def _read_available(fd: int) -> Tuple[bytes, bool]:
+    # Read everything currently available from the non-blocking fd, returning
+    # the data and whether end of file was reached
+    chunks: List[bytes] = []
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except BlockingIOError:
+            return b''.join(chunks), False
+        if not chunk:
+            return b''.join(chunks), True
+        chunks.append(chunk)
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_template(text: str) -> Template:
+    # Compiled Jinja templates keyed by the config file text, so reading the
+    # same config again skips compilation but sees any edits to it
+    return Template(text)
+
+
+@functools.lru_cache(maxsize=128)
+def _parse_toml(text: str) -> Dict[str, Any]:
+    # Cached on the rendered text, rather than the file, as the rendering
+    # depends on the environment variables; callers must not mutate the result
+    return tomllib.loads(text)
+
+
+def _build_cache_dir(
+    path: Path,
+    patches: Optional[List],
+    options: List[str],
+    system: str,
+    hdf5_path: Optional[Path] = None,
+) -> Optional[Path]:
+    # The build cache directory for the checked out commit, the patches, in
+    # order, the make options, and the toolchain, so that builds are not
+    # shared between hosts or compilers, e.g. on an HPC cluster with several
+    # node types and compiler modules. The compiler is FC if set, otherwise
+    # assumed to be named after the Phantom SYSTEM, as e.g. gfortran and
+    # ifort are. None if the compiler version cannot be determined
+    compiler = _compiler_version(
+        os.environ.get('FC') or system, os.environ.get('PATH', os.defpath)
+    )
+    if compiler is None:
+        return None
+    commit = _head_commit(path) or _cached_git(['rev-parse', 'HEAD'], cwd=path)
+    digest = hashlib.sha256(commit.encode())
+    for patch in patches or []:
+        digest.update(hashlib.sha256(_resolved_path(patch).read_bytes()).digest())
+    toolchain = [platform.machine(), compiler]
+    toolchain += [f'{key}={os.environ.get(key, "")}' for key in _BUILD_CACHE_ENV]
+    if hdf5_path is not None:
+        for lib in sorted(hdf5_path.glob('lib*/libhdf5*')):
+            stat = lib.stat()
+            toolchain.append(f'{lib.name} {stat.st_size} {stat.st_mtime_ns}')
+    for item in [*options, *toolchain]:
+        digest.update(item.encode() + b'\0')
+    return _resolved_path(os.environ['PHANTOMBUILD_CACHE_DIR']) / digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=32)
+def _compiler_version(compiler: str, search_path: str) -> Optional[str]:
+    # The path and --version output of compiler as found on search_path, which
+    # is part of the cache key as loading a compiler module changes it; None if
+    # the compiler cannot be found or run
+    executable = shutil.which(compiler, path=search_path)
+    if executable is None:
+        return None
+    try:
+        result = subprocess.run(
+            [executable, '--version'],
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding='utf-8',
+            errors='replace',
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{executable}\n{result.stdout.strip()}'
+
+
+def _restore_build(cache_dir: Path, path: Path) -> bool:
+    # Copy the cached build artifacts into the repository, returning False if
+    # they are not all cached. Existing files are unlinked rather than
+    # overwritten, as run directories may hard link them
+    if not all((cache_dir / file.name).is_file() for file in _BUILD_ARTIFACTS):
+        return False
+    (path / 'bin').mkdir(exist_ok=True)
+    for file in _BUILD_ARTIFACTS:
+        dst = path / file
+        if dst.exists() or dst.is_symlink():
+            dst.unlink()
+        shutil.copyfile(cache_dir / file.name, dst)
+        shutil.copymode(cache_dir / file.name, dst)
+    return True
+
+
+def _store_build(path: Path, cache_dir: Path):
+    # Copy the build artifacts into the cache, via a temporary directory
+    # renamed into place so that concurrent builds never see a partial entry
+    if cache_dir.exists():
+        return
+    tmp_dir: Optional[Path] = None
+    try:
+        cache_dir.parent.mkdir(parents=True, exist_ok=True)
+        # A unique name, as builds in other threads or processes may store the
+        # same entry, with the permissions of a directory made with mkdir
+        tmp_dir = Path(
+            tempfile.mkdtemp(
+                prefix=f'{cache_dir.name}.', suffix='.tmp', dir=cache_dir.parent
+            )
+        )
+        shutil.copymode(cache_dir.parent, tmp_dir)
+        for file in _BUILD_ARTIFACTS:
+            shutil.copyfile(path / file, tmp_dir / file.name)
+            shutil.copymode(path / file, tmp_dir / file.name)
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # Another build stored the same entry first
+            if not cache_dir.is_dir():
+                raise
+        logger.info(f'Phantom and Phantomsetup stored in cache: {cache_dir}')
+    except OSError as err:
+        logger.warning(f'Failed to store build in cache: {err}')
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _parse_jobs(value: Optional[str], name: str) -> Optional[int]:
+    # The number of make jobs given by value, from the option or environment
+    # variable name, or None, with a warning if set, if it is unset or not a
+    # positive integer
+    if value is None or value == '':
+        return None
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        logger.warning(
+            f'Ignoring {name}={value}: the number of jobs must be a positive integer'
+        )
+        return None
+    return jobs
+
+
+def _build_is_current(path: Path, build_hash: str) -> bool:
+    bin_path = path / 'bin'
+    try:
+        if (bin_path / '.build_hash').read_text() != build_hash:
+            return False
+        bin_mtime = min(
+            (bin_path / file).stat().st_mtime_ns for file in ('phantom', 'phantomsetup')
+        )
+        makefiles = [path / 'Makefile', *(path / 'build').glob('Makefile*')]
+        src_mtime = max(
+            _newest_mtime(path / 'src'),
+            *(file.stat().st_mtime_ns for file in makefiles),
+        )
+    except OSError:
+        return False
+    return src_mtime < bin_mtime
+
+
+def _newest_mtime(path: Path) -> int:
+    # The newest modification time of path and everything below it
+    newest = path.stat().st_mtime_ns
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                newest = max(newest, _newest_mtime(Path(entry.path)))
+            else:
+                newest = max(newest, entry.stat(follow_symlinks=False).st_mtime_ns)
+    return newest
+
+
+def _is_hash_prefix(version: str) -> bool:
+    # Whether version looks like a git commit hash, possibly abbreviated
+    return 7 <= len(version) <= 64 and all(c in '0123456789abcdef' for c in version)
+
+
+def _link_or_copy(src: Path, dst: Path):
+    # Hard link src to dst, replacing dst, or copy it with its mode if src and
+    # dst are on different filesystems or linking is not supported
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+        shutil.copymode(src, dst)
+
+
+def _find_failing_patch(
+    path: Path, patches: List[Path], texts: List[str]
+) -> Optional[Tuple[Path, str]]:
+    # Check ever longer runs of the patches, without applying them, to find the
+    # first that fails on top of those before it, with the error from git
+    for idx, patch in enumerate(patches):
+        try:
+            _run_git(
+                ['apply', '--check'],
+                cwd=path,
+                output=False,
+                input=''.join(texts[: idx + 1]),
+            )
+        except subprocess.CalledProcessError as err:
+            return patch, err.stderr.strip()
+    return None
+
+
+def _is_full_hash(version: str) -> bool:
+    # Whether version is a full (SHA-1 or SHA-256) git commit hash
+    return len(version) in (40, 64) and all(c in '0123456789abcdef' for c in version)
+
+
+def _read_patch(patch: Union[Path, str]) -> Tuple[Path, Optional[str]]:
+    # Resolve a patch file path and read it, or None if the file does not
+    # exist. The bytes are kept as is, see _run_git, and each patch ends with
+    # a newline so that they can be concatenated
+    _patch = _resolved_path(patch)
+    if not _patch.is_file():
+        return _patch, None
+    with open(_patch, encoding='utf-8', errors='surrogateescape', newline='') as fp:
+        text = fp.read()
+    if text and not text.endswith('\n'):
+        text += '\n'
+    return _patch, text
+
+
+def _invalidate_git_state(path: Path, worktree: bool = True):
+    # Forget the versions verified for path and, if worktree is True, that its
+    # working tree is clean
+    with _GIT_STATE_LOCK:
+        for key in [key for key in _GIT_STATE_CACHE if key[0] == path]:
+            del _GIT_STATE_CACHE[key]
+        if worktree:
+            _CLEAN_WORKTREES.pop(path, None)
+
+
+def _run_git(args: List[str], cwd: Path, output: bool = True, input: str = None) -> str:
+    # Run git, with input on stdin if given, returning its stripped stdout, or
+    # '' with stdout discarded if output is False; raises CalledProcessError,
+    # with stderr captured, on failure. Text is UTF-8, with undecodable bytes
+    # passed through unchanged as surrogates
+    result = subprocess.run(
+        ['git', *args],
+        cwd=cwd,
+        check=True,
+        input=input,
+        stdout=subprocess.PIPE if output else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        encoding='utf-8',
+        errors='surrogateescape',
+    )
+    return result.stdout.strip() if output else ''
+
+
+def _worktree_is_dirty(path: Path) -> bool:
+    # Whether git status reports any change, stopping at the first reported.
+    # --no-optional-locks stops git status refreshing the index, which would
+    # take the index lock and write it back
+    process = subprocess.Popen(
+        ['git', '--no-optional-locks', 'status', '--porcelain'],
+        cwd=path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    assert process.stdout is not None
+    with process.stdout:
+        dirty = bool(process.stdout.readline())
+    if dirty:
+        process.kill()
+    returncode = process.wait()
+    if not dirty and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, process.args)
+    return dirty
+
+
+def _cached_git(args: List[str], cwd: Path) -> str:
+    # As _run_git, but for read-only commands whose output can only change
+    # when HEAD moves; failures are not cached
+    if not _probe_cache_enabled():
+        return _run_git(args, cwd)
+    try:
+        key = (cwd, _head_signature(cwd), tuple(args))
+    except OSError:
+        return _run_git(args, cwd)
+    output = _GIT_CACHE.get(key)
+    if output is None:
+        output = _run_git(args, cwd)
+        with _GIT_STATE_LOCK:
+            _GIT_CACHE[key] = output
+    return output
+
+
+def _probe_cache_enabled() -> bool:
+    # Whether the git state cached during this session may be used; set the
+    # environment variable PHANTOMBUILD_PROBE_CACHE=0 to always query git, e.g.
+    # if the repository is also modified outside phantom-build
+    return os.environ.get('PHANTOMBUILD_PROBE_CACHE', '1') != '0'
+
+
+def _head_signature(path: Path) -> Tuple[int, ...]:
+    # Inode numbers and modification times of .git/HEAD and, if HEAD is a
+    # branch, of the file holding that branch (its loose ref or packed-refs).
+    # git replaces these files by renaming a new file over them, so the inode
+    # changes even if the modification time does not.
+    git_dir = path / '.git'
+    head = git_dir / 'HEAD'
+    files = [head]
+    content = head.read_text().strip()
+    if content.startswith('ref: '):
+        ref = git_dir / content[len('ref: ') :]
+        files.append(ref if ref.exists() else git_dir / 'packed-refs')
+    signature: List[int] = list()
+    for file in files:
+        stat = file.stat()
+        signature += [stat.st_ino, stat.st_mtime_ns]
+    return tuple(signature)
+
+
+def _head_commit(path: Path) -> Optional[str]:
+    # The commit hash HEAD points to, read from .git/HEAD and the loose ref or
+    # packed-refs it names, without running git; None if it cannot be read
+    # like this, e.g. for an unborn branch or if .git is not a directory
+    git_dir = path / '.git'
+    try:
+        content = (git_dir / 'HEAD').read_text().strip()
+        if not content.startswith('ref: '):
+            return content if _is_full_hash(content) else None
+        ref = content[len('ref: ') :]
+        ref_file = git_dir / ref
+        if ref_file.exists():
+            sha = ref_file.read_text().strip()
+            return sha if _is_full_hash(sha) else None
+        with open(git_dir / 'packed-refs') as fp:
+            for line in fp:
+                sha, _, name = line.strip().partition(' ')
+                if name == ref and _is_full_hash(sha):
+                    return sha
+    except OSError:
+        pass
+    return None
+
+
+def _is_phantom_remote(path: Path) -> bool:
+    # Read the origin URL from .git/config directly, only running git if that
+    # does not give a Phantom remote, e.g. if the config is missing, malformed,
+    # or uses features such as include directives
+    parser = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        parser.read(path / '.git' / 'config')
+        url = parser.get('remote "origin"', 'url', fallback='')
+    except configparser.Error:
+        url = ''
+    if _normalized_remote(url) in PHANTOM_REMOTES:
+        return True
+
+    try:
+        url = _run_git(['config', '--local', '--get', 'remote.origin.url'], cwd=path)
+    except subprocess.CalledProcessError:
+        return False
+    return _normalized_remote(url) in PHANTOM_REMOTES
+
+
+def _normalized_remote(url: str) -> str:
+    # E.g. both 'git@github.com:danieljprice/phantom.git' and
+    # 'https://github.com/danieljprice/phantom' become
+    # 'github.com/danieljprice/phantom'
+    url = url.strip().rstrip('/')
+    if url.endswith('.git'):
+        url = url[: -len('.git')]
+    return url.split('://', 1)[-1].split('@', 1)[-1].replace(':', '/')
+
+
+def _git_config_signature(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = (path / '.git' / 'config').stat()
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
 def _resolved_path(inp: Union[str, Path]) -> Path:
-    return pathlib.Path(inp).expanduser().resolve()
+    return _resolve(os.fspath(inp), os.getcwd())
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve(inp: str, cwd: str) -> Path:
+    # The working directory is part of the cache key as relative paths are
+    # resolved against it
+    path = pathlib.Path(inp).expanduser()
+    if not path.is_absolute():
+        path = pathlib.Path(cwd) / path
+    return path.resolve()
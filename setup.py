@@ -1,19 +1,23 @@
 """Phantom-build setup.py."""
 
-import io
 import pathlib
-import re
+import sys
 
 from setuptools import setup
 
-version = re.search(
-    r'__version__\s*=\s*[\'"]([^\'"]*)[\'"]',
-    io.open('phantombuild/__init__.py', encoding='utf_8_sig').read(),
-).group(1)
+init = (pathlib.Path(__file__).parent / 'phantombuild' / '__init__.py').read_bytes()
+start = init.index(b'=', init.index(b'__version__')) + 1
+version = init[start:].split(b'\n', 1)[0].strip().strip(b'\'"').decode()
 
-long_description = (pathlib.Path(__file__).parent / 'README.md').read_text()
+# Only read the README for commands that write the package metadata
+kwargs = {}
+if any(cmd in sys.argv for cmd in ('sdist', 'bdist_wheel', 'dist_info', 'egg_info')):
+    kwargs['long_description'] = (
+        pathlib.Path(__file__).parent / 'README.md'
+    ).read_text(encoding='utf-8')
+    kwargs['long_description_content_type'] = 'text/markdown'
 
-install_requires = ['click', 'jinja2', 'tomlkit']
+install_requires = ['click', 'jinja2', 'tomli; python_version < "3.11"']
 
 setup(
     name='phantombuild',
@@ -24,10 +28,8 @@ setup(
     url='http://github.com/dmentipl/phantom-build',
     license='MIT',
     description='phantom-build is designed to make building Phantom easier',
-    long_description=long_description,
-    long_description_content_type='text/markdown',
     install_requires=install_requires,
-    include_package_data=True,
+    package_data={'phantombuild': ['template.toml']},
     python_requires='>=3.7',
     classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -36,4 +38,5 @@ setup(
         "Programming Language :: Python :: 3.8",
         "Operating System :: OS Independent",
     ],
+    **kwargs,
 )
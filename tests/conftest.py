@@ -0,0 +1,162 @@
+"""Fixtures for testing phantombuild."""
+
+import contextlib
+import fcntl
+import functools
+import hashlib
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import phantombuild as pb
+
+VERSION = '3252f52501cac9565f9bc40527346c0e224757b9'
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-slow', action='store_true', help='run tests marked as slow')
+
+
+def pytest_collection_modifyitems(config, items):
+    # Tests using the Phantom clone need network access, at least the first
+    # time the cache is filled
+    for item in items:
+        if 'phantom_cache' in getattr(item, 'fixturenames', ()):
+            item.add_marker(pytest.mark.network)
+    if config.getoption('--run-slow'):
+        return
+    skip_slow = pytest.mark.skip(reason='use --run-slow to run')
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip_slow)
+
+
+@pytest.fixture(scope='session')
+def phantom_cache(tmp_path_factory):
+    """Clone Phantom, at VERSION, once and reuse it across test sessions.
+
+    The clone is kept in PHANTOM_TEST_CACHE, or by default in
+    ~/.cache/phantombuild-tests, keyed by VERSION.
+    """
+    cache_root = Path(
+        os.environ.get('PHANTOM_TEST_CACHE', Path.home() / '.cache/phantombuild-tests')
+    ).expanduser()
+    path = cache_root / hashlib.sha1(VERSION.encode()).hexdigest()
+    cache_root.mkdir(parents=True, exist_ok=True)
+    # Only one pytest-xdist worker clones, the others wait for it
+    with _locked(path.with_suffix('.lock')):
+        if not (path / '.git').exists():
+            # Clone into a temporary directory first so that an interrupted
+            # clone is never mistaken for a cached one
+            tmp_path = tmp_path_factory.mktemp('phantom-cache') / 'phantom'
+            pb.get_phantom(tmp_path)
+            pb.checkout_phantom_version(path=tmp_path, version=VERSION)
+            shutil.rmtree(path, ignore_errors=True)
+            shutil.move(str(tmp_path), str(path))
+        pb.checkout_phantom_version(path=path, version=VERSION)
+    return path
+
+
+@contextlib.contextmanager
+def _locked(lock_file):
+    with open(lock_file, 'w') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+@pytest.fixture
+def phantom_dir(phantom_cache, tmp_path):
+    """Copy of the Phantom clone for one test.
+
+    Files are hardlinked to the cache where possible. Git and the tests
+    replace files rather than modify them in place, so changes in one copy
+    do not leak into the cache.
+    """
+    path = tmp_path / 'phantom'
+    if os.stat(phantom_cache).st_dev == os.stat(tmp_path).st_dev:
+        copy_function = functools.partial(_link_or_copy, git_dir=phantom_cache / '.git')
+    else:
+        copy_function = shutil.copy2
+    shutil.copytree(phantom_cache, path, symlinks=True, copy_function=copy_function)
+    return path
+
+
+def _link_or_copy(src, dst, git_dir):
+    # Git appends to some of its own files in place, e.g. reflogs, so only the
+    # object store and working tree are shared
+    parents = Path(src).parents
+    if git_dir in parents and git_dir / 'objects' not in parents:
+        return shutil.copy2(src, dst)
+    os.link(src, dst)
+    return dst
+
+
+@pytest.fixture
+def phantom_stub(tmp_path):
+    """Empty git repository with Phantom as its origin.
+
+    For tests of the repository checks that do not need the Phantom source,
+    and so can run offline.
+    """
+    path = tmp_path / 'phantom'
+    subprocess.run(['git', 'init', '-q', str(path)], check=True)
+    subprocess.run(
+        ['git', 'remote', 'add', 'origin', pb.phantombuild.REPO_URL],
+        cwd=path,
+        check=True,
+    )
+    return path
+
+
+@pytest.fixture
+def phantom_remote(tmp_path, monkeypatch):
+    """Local bare repository standing in for the Phantom remote.
+
+    The default branch has two commits, with the first tagged 'v1', and
+    the branch 'side' has one more commit. Returns the commit hashes by
+    name.
+    """
+    work = tmp_path / 'remote-work'
+    env = {
+        **os.environ,
+        'GIT_AUTHOR_NAME': 'phantombuild',
+        'GIT_AUTHOR_EMAIL': 'phantombuild@example.com',
+        'GIT_COMMITTER_NAME': 'phantombuild',
+        'GIT_COMMITTER_EMAIL': 'phantombuild@example.com',
+    }
+
+    def git(*args):
+        return subprocess.run(
+            ['git', *args],
+            cwd=work,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    def commit(message):
+        (work / 'file.txt').write_text(message)
+        git('add', 'file.txt')
+        git('commit', '-q', '-m', message)
+        return git('rev-parse', 'HEAD')
+
+    work.mkdir()
+    git('init', '-q', '-b', 'master')
+    commits = {'first': commit('first')}
+    git('tag', 'v1')
+    git('checkout', '-q', '-b', 'side')
+    commits['side'] = commit('side')
+    git('checkout', '-q', 'master')
+    commits['second'] = commit('second')
+    bare = tmp_path / 'remote.git'
+    git('clone', '-q', '--bare', str(work), str(bare))
+    # Use a file:// URL as git ignores --depth for local paths
+    monkeypatch.setattr(pb.phantombuild, 'REPO_URL', bare.as_uri())
+    return commits
@@ -1,6 +1,10 @@
 """Testing phantombuild."""
 
-import tempfile
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import pytest
@@ -11,98 +15,407 @@ from phantombuild.phantombuild import (
     HDF5LibraryNotFound,
     PatchError,
     RepoError,
+    TOMLError,
 )
 
-VERSION = '3252f52501cac9565f9bc40527346c0e224757b9'
+from .conftest import VERSION
 
+STUB_DIR = Path(__file__).resolve().parent / 'stub'
+TEST_PATCH = STUB_DIR / 'test.patch'
+DISC_IN = STUB_DIR / 'disc.in'
+DISC_SETUP = STUB_DIR / 'disc.setup'
 
-def test_get_phantom():
-    """Test getting Phantom from GitHub."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        path = Path(tmpdirname) / 'phantom'
-        pb.get_phantom(path)
-        pb.get_phantom(path)
-        (path / '.git/config').unlink()
-        with pytest.raises(RepoError):
-            pb.get_phantom(path)
 
+def test_import(tmp_path):
+    """Test importing phantombuild does not create the log file."""
+    env = {**os.environ, 'PYTHONPATH': str(Path(pb.__file__).parent.parent)}
+    subprocess.run(
+        [sys.executable, '-c', 'import phantombuild'],
+        cwd=tmp_path,
+        env=env,
+        check=True,
+    )
+    assert not (tmp_path / '.phantom-build.log').exists()
 
-def test_checkout_phantom_version_clean():
+
+def test_get_phantom(phantom_stub):
+    """Test checking an existing Phantom repository."""
+    pb.get_phantom(phantom_stub)
+    (phantom_stub / '.git/config').unlink()
+    with pytest.raises(RepoError):
+        pb.get_phantom(phantom_stub)
+
+
+@pytest.mark.parametrize(
+    'url, is_phantom',
+    [
+        ('git@github.com:danieljprice/phantom.git', True),
+        ('https://github.com/danieljprice/phantom.git', True),
+        ('https://github.com/danieljprice/phantom', True),
+        ('https://github.com/danieljprice/phantom/', True),
+        ('ssh://git@github.com/danieljprice/phantom.git', True),
+        ('https://github.com/dmentipl/phantom.git', False),
+        ('git@github.com:danieljprice/phantom-fork.git', False),
+    ],
+)
+def test_normalized_remote(url, is_phantom):
+    """Test recognizing Phantom remote URLs."""
+    module = pb.phantombuild
+    assert (module._normalized_remote(url) in module.PHANTOM_REMOTES) is is_phantom
+
+
+@pytest.mark.slow
+@pytest.mark.network
+def test_get_phantom_full_history(tmp_path):
+    """Test cloning Phantom with its full history."""
+    path = tmp_path / 'phantom'
+    pb.get_phantom(path, shallow=False)
+    assert not (path / '.git/shallow').exists()
+    pb.checkout_phantom_version(path=path, version=VERSION)
+
+
+def test_checkout_phantom_version_shallow(phantom_remote, tmp_path):
+    """Test checking out versions missing from a shallow clone."""
+    path = tmp_path / 'phantom'
+    pb.get_phantom(path)
+    assert (path / '.git/shallow').exists()
+    pb.checkout_phantom_version(path=path, version=phantom_remote['side'][:7])
+    assert (path / 'file.txt').read_text() == 'side'
+    pb.checkout_phantom_version(path=path, version='v1')
+    assert (path / 'file.txt').read_text() == 'first'
+
+
+def test_checkout_phantom_version_worktree(phantom_remote, tmp_path):
+    """Test checking out a Phantom version in a linked worktree."""
+    path = tmp_path / 'phantom'
+    worktree = tmp_path / 'worktree'
+    pb.get_phantom(path)
+    subprocess.run(
+        ['git', 'worktree', 'add', '-q', '--detach', str(worktree)],
+        cwd=path,
+        check=True,
+    )
+    assert (worktree / '.git').is_file()
+    version = phantom_remote['second']
+    assert pb.checkout_phantom_version(path=worktree, version=version)
+
+
+def test_checkout_phantom_version_status_fails(phantom_remote, tmp_path):
+    """Test a failing git status raises RepoError."""
+    path = tmp_path / 'phantom'
+    pb.get_phantom(path)
+    (path / '.git/index').write_bytes(b'corrupt')
+    with pytest.raises(RepoError):
+        pb.checkout_phantom_version(path=path, version=phantom_remote['second'])
+
+
+def test_checkout_phantom_version_clean(phantom_dir):
     """Test checking out a Phantom version."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        path = Path(tmpdirname) / 'phantom'
-        pb.get_phantom(path)
-        pb.checkout_phantom_version(path=path, version=VERSION)
-        pb.checkout_phantom_version(path=path, version=VERSION)
+    pb.checkout_phantom_version(path=phantom_dir, version=VERSION)
+    pb.checkout_phantom_version(path=phantom_dir, version=VERSION)
 
 
-def test_checkout_phantom_version_dirty():
+def test_checkout_phantom_version_dirty(phantom_dir):
     """Test checking out a Phantom version."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        path = Path(tmpdirname) / 'phantom'
-        pb.get_phantom(path)
-        (path / 'src/main/phantom.F90').unlink()
-        pb.checkout_phantom_version(path=path, version=VERSION)
+    (phantom_dir / 'src/main/phantom.F90').unlink()
+    pb.checkout_phantom_version(path=phantom_dir, version=VERSION)
+    assert (phantom_dir / 'src/main/phantom.F90').exists()
 
 
-def test_phantom_patch():
+def test_invalidate_git_state_threads(tmp_path):
+    """Test invalidating cached git state while another thread adds to it."""
+    module = pb.phantombuild
+    paths = [tmp_path / 'a', tmp_path / 'b']
+
+    def add():
+        for idx in range(10000):
+            with module._GIT_STATE_LOCK:
+                module._GIT_STATE_CACHE[(paths[0], str(idx))] = 'clean'
+
+    def invalidate():
+        for _ in range(500):
+            module._invalidate_git_state(paths[1])
+
+    # Switch threads often to make a race likely
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(add), executor.submit(invalidate)]
+    finally:
+        sys.setswitchinterval(interval)
+    for future in futures:
+        future.result()
+    module._invalidate_git_state(paths[0])
+    assert not any(key[0] in paths for key in module._GIT_STATE_CACHE)
+
+
+def test_phantom_patch(phantom_dir):
     """Test patching Phantom."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        path = Path(tmpdirname) / 'phantom'
-        pb.get_phantom(path)
-        pb.checkout_phantom_version(path=path, version=VERSION)
-        patch = Path(__file__).parent / 'stub' / 'test.patch'
-        pb.patch_phantom(path=path, patch=patch)
-        kwargs = {'path': path, 'patch': patch}
-        with pytest.raises(PatchError):
-            pb.patch_phantom(**kwargs)
-
-
-def test_build_phantom():
+    pb.checkout_phantom_version(path=phantom_dir, version=VERSION)
+    patch = TEST_PATCH
+    pb.patch_phantom(path=phantom_dir, patch=patch)
+    kwargs = {'path': phantom_dir, 'patch': patch}
+    with pytest.raises(PatchError):
+        pb.patch_phantom(**kwargs)
+
+
+def test_phantom_patch_batch(phantom_dir, tmp_path):
+    """Test patching Phantom with several patches at once."""
+    pb.checkout_phantom_version(path=phantom_dir, version=VERSION)
+    patch = TEST_PATCH
+    # The second patch fails on top of the first, so neither is applied
+    second_patch = tmp_path / 'second.patch'
+    second_patch.write_bytes(patch.read_bytes())
+    kwargs = {'path': phantom_dir, 'patches': [patch, second_patch]}
+    with pytest.raises(PatchError, match=re.escape(str(second_patch))):
+        pb.patch_phantom_batch(**kwargs)
+    status = subprocess.run(
+        ['git', 'status', '--porcelain'],
+        cwd=phantom_dir,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    assert status.stdout == ''
+    pb.patch_phantom_batch(path=phantom_dir, patches=[patch])
+    kwargs = {'path': phantom_dir, 'patches': [patch]}
+    with pytest.raises(PatchError):
+        pb.patch_phantom_batch(**kwargs)
+    kwargs = {'path': phantom_dir, 'patches': [patch, 'non_existent.patch']}
+    with pytest.raises(PatchError):
+        pb.patch_phantom_batch(**kwargs)
+
+
+def test_phantom_patch_batch_empty(phantom_stub):
+    """Test patching Phantom with no patches does nothing."""
+    assert pb.patch_phantom_batch(path=phantom_stub, patches=[])
+
+
+@pytest.mark.parametrize('method', ['tee', 'splice', 'select'])
+def test_run_and_tee(tmp_path, monkeypatch, capfd, method):
+    """Test copying command output to a log, with tee and its fallbacks."""
+    module = pb.phantombuild
+    if method != 'tee':
+        monkeypatch.setattr(module.shutil, 'which', lambda name: None)
+        monkeypatch.setattr(module, '_LOG_FLUSH_INTERVAL', 0)
+    if method == 'select':
+        monkeypatch.delattr(os, 'splice', raising=False)
+    log_path = tmp_path / 'build_output.log'
+    with open(log_path, 'w+b', buffering=0) as log:
+        command = ['sh', '-c', 'echo out; echo err >&2; exit 3']
+        assert module._run_and_tee(command, cwd=tmp_path, log_fd=log.fileno()) == 3
+        command = ['sh', '-c', 'echo more']
+        assert module._run_and_tee(command, cwd=tmp_path, log_fd=log.fileno()) == 0
+    assert log_path.read_bytes() == b'out\nerr\nmore\n'
+    assert capfd.readouterr().out == 'out\nerr\nmore\n'
+
+
+@pytest.mark.parametrize(
+    'value, jobs',
+    [
+        (None, None),
+        ('', None),
+        ('4', 4),
+        ('1', 1),
+        ('0', None),
+        ('-2', None),
+        ('abc', None),
+    ],
+)
+def test_parse_jobs(value, jobs):
+    """Test parsing the number of make jobs."""
+    assert pb.phantombuild._parse_jobs(value, 'JOBS') == jobs
+
+
+def test_build_is_current(tmp_path):
+    """Test deciding whether the Phantom binaries need to be rebuilt."""
+    is_current = pb.phantombuild._build_is_current
+    path = tmp_path / 'phantom'
+    for file in ('src/main/phantom.F90', 'Makefile', 'build/Makefile'):
+        (path / file).parent.mkdir(parents=True, exist_ok=True)
+        (path / file).write_text('')
+    for file in (
+        'src/main/phantom.F90',
+        'src/main',
+        'src',
+        'Makefile',
+        'build/Makefile',
+    ):
+        os.utime(path / file, (1000, 1000))
+    (path / 'bin').mkdir()
+    for file in ('phantom', 'phantomsetup'):
+        (path / 'bin' / file).write_text('')
+        os.utime(path / 'bin' / file, (2000, 2000))
+    (path / 'bin/.build_hash').write_text('hash')
+
+    assert is_current(path, 'hash')
+    assert not is_current(path, 'other-hash')
+
+    os.utime(path / 'src/main/phantom.F90', (3000, 3000))
+    assert not is_current(path, 'hash')
+    os.utime(path / 'src/main/phantom.F90', (1000, 1000))
+
+    os.utime(path / 'build/Makefile', (3000, 3000))
+    assert not is_current(path, 'hash')
+    os.utime(path / 'build/Makefile', (1000, 1000))
+
+    (path / 'bin/phantomsetup').unlink()
+    assert not is_current(path, 'hash')
+
+
+def test_build_cache_dir(tmp_path, monkeypatch):
+    """Test the build cache directory depends on all the build inputs."""
+    module = pb.phantombuild
+    monkeypatch.setenv('PHANTOMBUILD_CACHE_DIR', str(tmp_path / 'cache'))
+    for key in module._BUILD_CACHE_ENV:
+        monkeypatch.delenv(key, raising=False)
+    # Two versions of a fake compiler, as if from different compiler modules
+    for version in ('1', '2'):
+        compiler = tmp_path / f'compiler-{version}' / 'fakefc'
+        compiler.parent.mkdir()
+        compiler.write_text(f'#!/bin/sh\necho fakefc {version}\n')
+        compiler.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path / 'compiler-1'))
+    path = tmp_path / 'phantom'
+    (path / '.git').mkdir(parents=True)
+    (path / '.git/HEAD').write_text(VERSION + '\n')
+    patch = tmp_path / 'test.patch'
+    patch.write_text('a')
+    options = ['SETUP=disc', 'SYSTEM=fakefc']
+
+    def cache_dir(patches=(patch,), options=options, system='fakefc', **kwargs):
+        return module._build_cache_dir(path, patches, options, system, **kwargs)
+
+    expected = cache_dir()
+    assert expected.parent == tmp_path / 'cache'
+    assert cache_dir() == expected
+    assert cache_dir(patches=None) != expected
+    assert cache_dir(options=options[:1]) != expected
+    patch.write_text('b')
+    assert cache_dir() != expected
+    patch.write_text('a')
+    (path / '.git/HEAD').write_text('0' * 40 + '\n')
+    assert cache_dir() != expected
+    (path / '.git/HEAD').write_text(VERSION + '\n')
+    assert cache_dir() == expected
+
+    # Toolchain
+    with monkeypatch.context() as context:
+        context.setattr(module.platform, 'machine', lambda: 'other-arch')
+        assert cache_dir() != expected
+    with monkeypatch.context() as context:
+        context.setenv('FFLAGS', '-O0')
+        assert cache_dir() != expected
+    with monkeypatch.context() as context:
+        context.setenv('PATH', str(tmp_path / 'compiler-2'))
+        assert cache_dir() != expected
+    hdf5_lib = tmp_path / 'hdf5' / 'lib' / 'libhdf5.so'
+    hdf5_lib.parent.mkdir(parents=True)
+    hdf5_lib.write_text('')
+    with_hdf5 = cache_dir(hdf5_path=tmp_path / 'hdf5')
+    hdf5_lib.write_text('new version')
+    assert cache_dir(hdf5_path=tmp_path / 'hdf5') != with_hdf5
+    assert cache_dir() == expected
+
+    # Unknown compiler
+    assert cache_dir(system='nonexistentfc') is None
+
+
+def test_build_cache(tmp_path, caplog):
+    """Test storing builds in, and restoring them from, the build cache."""
+    module = pb.phantombuild
+    build = _make_build_tree(tmp_path / 'build')
+    other = tmp_path / 'other'
+    (other / 'build').mkdir(parents=True)
+    cache_dir = tmp_path / 'cache' / 'key'
+
+    # Miss
+    assert not module._restore_build(cache_dir, other)
+
+    # Store, from several threads at once
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(4):
+            executor.submit(module._store_build, build, cache_dir)
+    assert sorted(file.name for file in cache_dir.parent.iterdir()) == ['key']
+    assert not [record for record in caplog.records if record.levelname == 'WARNING']
+
+    # Hit
+    assert module._restore_build(cache_dir, other)
+    for file in module._BUILD_ARTIFACTS:
+        assert (other / file).read_text() == file.name
+    assert os.access(other / 'bin/phantom', os.X_OK)
+
+    # Partial entry
+    (cache_dir / 'phantomsetup').unlink()
+    assert not module._restore_build(cache_dir, tmp_path / 'partial')
+
+
+def _make_build_tree(path):
+    # A Phantom repository with (fake) build artifacts
+    for file in pb.phantombuild._BUILD_ARTIFACTS:
+        (path / file).parent.mkdir(parents=True, exist_ok=True)
+        (path / file).write_text(file.name)
+        (path / file).chmod(0o755)
+    return path
+
+
+@pytest.mark.slow
+@pytest.mark.xdist_group('build')
+def test_build_phantom(phantom_dir):
     """Test building Phantom."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        path = Path(tmpdirname) / 'phantom'
-        hdf5_path = Path('non_existent_dir')
-        pb.get_phantom(path)
-        pb.build_phantom(
-            path=path,
-            setup='empty',
-            system='gfortran',
-            extra_options={'MAXP': '1000000'},
-        )
-        kwargs = {
-            'path': path,
-            'setup': 'empty',
-            'system': 'gfortran',
-            'hdf5_path': hdf5_path,
-        }
-        with pytest.raises(HDF5LibraryNotFound):
-            pb.build_phantom(**kwargs)
-        kwargs = {
-            'path': path,
-            'setup': 'FakeSetup',
-            'system': 'gfortran',
-        }
-        with pytest.raises(CompileError):
-            pb.build_phantom(**kwargs)
-
-
-def test_setup_calculation():
+    hdf5_path = Path('non_existent_dir')
+    pb.build_phantom(
+        path=phantom_dir,
+        setup='empty',
+        system='gfortran',
+        extra_options={'MAXP': '1000000'},
+    )
+    kwargs = {
+        'path': phantom_dir,
+        'setup': 'empty',
+        'system': 'gfortran',
+        'hdf5_path': hdf5_path,
+    }
+    with pytest.raises(HDF5LibraryNotFound):
+        pb.build_phantom(**kwargs)
+    kwargs = {
+        'path': phantom_dir,
+        'setup': 'FakeSetup',
+        'system': 'gfortran',
+    }
+    with pytest.raises(CompileError):
+        pb.build_phantom(**kwargs)
+
+
+@pytest.mark.slow
+@pytest.mark.xdist_group('build')
+def test_setup_calculation(phantom_dir, tmp_path):
     """Test setting up Phantom calculation."""
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        phantom_path = Path(tmpdirname) / 'phantom'
-        run_path = Path(tmpdirname) / 'run_path'
-        input_dir = Path(__file__).parent / 'stub'
-        in_file = input_dir / 'disc.in'
-        setup_file = input_dir / 'disc.setup'
-        pb.get_phantom(phantom_path)
-        pb.build_phantom(
-            path=phantom_path, version=VERSION, setup='disc', system='gfortran'
-        )
-        pb.setup_calculation(
-            prefix='disc',
-            setup_file=setup_file,
-            in_file=in_file,
-            run_path=run_path,
-            phantom_path=phantom_path,
-        )
+    run_path = tmp_path / 'run_path'
+    pb.build_phantom(path=phantom_dir, version=VERSION, setup='disc', system='gfortran')
+    pb.setup_calculation(
+        prefix='disc',
+        setup_file=DISC_SETUP,
+        in_file=DISC_IN,
+        run_path=run_path,
+        phantom_path=phantom_dir,
+    )
+
+
+def test_read_config(tmp_path):
+    """Test reading a config file."""
+    filename = tmp_path / 'config.toml'
+    filename.write_text(
+        '[phantom]\n'
+        'path = "phantom"\n'
+        'extra_options = ["MAXP = 1000000", "ISOTHERMAL=yes"]\n'
+    )
+    config = pb.read_config(filename)
+    assert config['phantom']['extra_options'] == {
+        'MAXP': '1000000',
+        'ISOTHERMAL': 'yes',
+    }
+    filename.write_text('[phantom]\nextra_options = ["MAXP 1000000"]\n')
+    with pytest.raises(TOMLError, match='MAXP 1000000'):
+        pb.read_config(filename)